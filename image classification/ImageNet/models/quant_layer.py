@@ -141,7 +141,19 @@ def uniform_quantization(tensor, alpha, bit, is_weight=True, grad_scale=None):
         data_q = data_q / (2 ** bit - 1) * alpha
     return data_q
 
-#Convolution defauts to APoT weight quantizaiton 
+def freeze_weight_quant(model):
+    """Precompute the quantized weights of every quant layer for inference.
+
+    The frozen QAT network re-projects its weights onto the quantization
+    levels on every forward; during evaluation the weights never change, so
+    the projection can be done once up front.
+    """
+    for m in model.modules():
+        if isinstance(m, (QuantConv2d, QuantLinear)):
+            m.freeze_weight()
+
+
+#Convolution defauts to APoT weight quantizaiton
 class QuantConv2d(nn.Conv2d):
     """Generates quantized convolutional layers.
 
@@ -175,11 +187,9 @@ class QuantConv2d(nn.Conv2d):
                     self.proj_set_weight = build_power_value(B=self.bit - 1, additive=additive)
                 self.proj_set_act = build_power_value(B=self.bit, additive=additive)
             self.weight_alpha = torch.nn.Parameter(torch.tensor(3.0))
+        self.weight_q = None
 
-    def forward(self, x):
-        if self.bit == 32:
-            return F.conv2d(x, self.weight, self.bias, self.stride,
-                            self.padding, self.dilation, self.groups)
+    def _quant_weight(self):
         # weight normalization
         mean = self.weight.mean()
         std = self.weight.std()
@@ -194,6 +204,24 @@ class QuantConv2d(nn.Conv2d):
                 weight = uniform_quantization(weight, self.weight_alpha, self.bit, True, self.grad_scale)
             else:
                 weight = uq_with_calibrated_graditens(self.grad_scale)(weight, self.weight_alpha)
+        return weight
+
+    def freeze_weight(self):
+        # cache the projected weights for inference; the projection is the
+        # expensive part of the forward and the weights do not change there
+        if self.bit == 32:
+            return
+        with torch.no_grad():
+            self.weight_q = self._quant_weight()
+
+    def unfreeze_weight(self):
+        self.weight_q = None
+
+    def forward(self, x):
+        if self.bit == 32:
+            return F.conv2d(x, self.weight, self.bias, self.stride,
+                            self.padding, self.dilation, self.groups)
+        weight = self.weight_q if self.weight_q is not None else self._quant_weight()
         return F.conv2d(x, weight, self.bias, self.stride,
                         self.padding, self.dilation, self.groups)
 
@@ -249,10 +277,9 @@ class QuantLinear(nn.Linear):
                     self.proj_set_weight = build_power_value(B=self.bit - 1, additive=additive)
                 self.proj_set_act = build_power_value(B=self.bit, additive=additive)
             self.weight_alpha = torch.nn.Parameter(torch.tensor(3.0))
-        
-    def forward(self, x):
-        if self.bit == 32:
-            return F.linear(x, self.weight, self.bias)
+        self.weight_q = None
+
+    def _quant_weight(self):
         # weight normalization
         mean = self.weight.mean()
         std = self.weight.std()
@@ -267,6 +294,21 @@ class QuantLinear(nn.Linear):
                 weight = uniform_quantization(weight, self.weight_alpha, self.bit, True, self.grad_scale)
             else:
                 weight = uq_with_calibrated_graditens(self.grad_scale)(weight, self.weight_alpha)
+        return weight
+
+    def freeze_weight(self):
+        if self.bit == 32:
+            return
+        with torch.no_grad():
+            self.weight_q = self._quant_weight()
+
+    def unfreeze_weight(self):
+        self.weight_q = None
+
+    def forward(self, x):
+        if self.bit == 32:
+            return F.linear(x, self.weight, self.bias)
+        weight = self.weight_q if self.weight_q is not None else self._quant_weight()
         return F.linear(x, weight, self.bias)
     
     def show_params(self):